@@ -1,3 +1,4 @@
 python -m src.prep.build_vault_dict --vault_path $1
 python -m src.prep.build_opensearch_index
-python -m src.prep.build_semantic_index
\ No newline at end of file
+python -m src.prep.build_semantic_index
+python -m src.prep.build_onnx_model
\ No newline at end of file
@@ -3,22 +3,26 @@ Simple FastAPI app that queries opensearch and a semantic index for retrieval-au
 """
 
 import os
-import pickle
-from typing import Dict, List
+from collections import defaultdict
+from functools import lru_cache
+from typing import List
 
 import numpy as np
-import pandas as pd
+import pyarrow as pa
 import tiktoken
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from transformers import AutoModel, AutoTokenizer
+from optimum.onnxruntime import ORTModelForFeatureExtraction
+from transformers import AutoTokenizer
 
 from src.logger import logger
+from src.prep.build_onnx_model import MODEL_NAME, ONNX_MODEL_FILE, ONNX_MODEL_PATH
 from src.prep.build_opensearch_index import INDEX_NAME, get_opensearch, query_opensearch
-from src.prep.build_semantic_index import query_semantic
+from src.prep.build_semantic_index import load_semantic_index, query_semantic
+from src.prep.build_vault_dict import TOKEN_COUNT_MODEL, load_vault_table
 
-# Load vault dictionary
-vault = pickle.load(open("data/vault_dict.pickle", "rb"))
+# Load vault dictionary of chunks; full docs aren't returned as context
+vault, vault_index = load_vault_table()
 logger.info(f"Vault loaded with {len(vault)} documents")
 
 # Create opensearch client
@@ -29,14 +33,13 @@ except ConnectionRefusedError:
 logger.info(f"OS client initialized: {os_client.info()}")
 
 # Load semantic index
-doc_embeddings_array = np.load("data/doc_embeddings_array.npy")
-with open("data/embedding_index.pickle", "rb") as f:
-    embedding_index = pickle.load(f)
-tokenizer = AutoTokenizer.from_pretrained(
-    "intfloat/e5-small-v2"
-)  # Max token length is 512
+semantic_index = load_semantic_index()
+embedding_index = np.load("data/embedding_index.npy")
+tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)  # Max token length is 512
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
-model = AutoModel.from_pretrained("intfloat/e5-small-v2")
+model = ORTModelForFeatureExtraction.from_pretrained(
+    ONNX_MODEL_PATH, file_name=ONNX_MODEL_FILE
+)  # int8 quantized ONNX model; see build_onnx_model.py
 logger.info(f"Semantic index loaded with {len(embedding_index)} documents")
 
 
@@ -77,13 +80,14 @@ def parse_os_response(response: dict) -> List[dict]:
 
 
 def parse_semantic_response(
-    indices: np.ndarray, embedding_index: Dict[int, str]
+    indices: np.ndarray, embedding_index: np.ndarray
 ) -> List[dict]:
     """
     Parse response from semantic index.
 
     Args:
         indices: Response from semantic query, an array of ints.
+        embedding_index: Array of chunk-ids, indexed by document embedding row.
 
     Returns:
         List of hits with chunkID and rank
@@ -91,25 +95,39 @@ def parse_semantic_response(
     hits = []
 
     for rank, idx in enumerate(indices):
-        hits.append({"id": embedding_index[idx], "rank": rank})
+        hits.append({"id": str(embedding_index[idx]), "rank": rank})
 
     return hits
 
 
-def num_tokens_from_string(string: str, model_name: str) -> int:
+@lru_cache(maxsize=8)
+def get_encoding(model_name: str) -> tiktoken.Encoding:
     """
-    Returns the number of tokens in a string based on tiktoken encoding.
+    Returns the tiktoken encoding for a model, cached so it's only looked up once per model.
 
     Args:
-        string: String to count tokens for
         model_name: Tokenizer model type
 
     Returns:
-        Number of tokens in the string
+        Tiktoken encoding for the model
     """
-    encoding = tiktoken.encoding_for_model(model_name)
-    num_tokens = len(encoding.encode(string))
-    return num_tokens
+    return tiktoken.encoding_for_model(model_name)
+
+
+def num_tokens_from_strings(strings: List[str], model_name: str) -> List[int]:
+    """
+    Returns the number of tokens in each string based on tiktoken encoding. Strings are encoded in parallel threads.
+
+    Args:
+        strings: Strings to count tokens for
+        model_name: Tokenizer model type
+
+    Returns:
+        Number of tokens in each string
+    """
+    encoding = get_encoding(model_name)
+    tokens = encoding.encode_ordinary_batch(strings, num_threads=4)
+    return [len(string_tokens) for string_tokens in tokens]
 
 
 def get_chunks_from_hits(
@@ -121,39 +139,32 @@ def get_chunks_from_hits(
     Args:
         hits: List of hits from opensearch, semantic index, etc.
         model_name: Downstream model for retrieval-augmented generation. Used to tokenize chunks and limit the size of
-            input based on LLM context window size. Defaults to 'gpt-3.5-turbo'.
+            input based on LLM context window size. Defaults to 'gpt-3.5-turbo', whose token counts are precomputed in
+            the vault.
         max_tokens: Maximum tokens to allow in chunks. Defaults to 3,200.
 
     Returns:
         List of chunks for retrieval-augmented generation.
     """
-    # Combine os and semantic hits and rank them
-    df = pd.DataFrame(hits)
-    df["score"] = df["rank"].apply(lambda x: 10 - x)
-    # deduplicate chunks by ID, summing their OS and semantic scores
-    ranked = (
-        df.groupby("id")
-        .agg({"score": "sum"})
-        .sort_values("score", ascending=False)
-        .reset_index()
-    )
-
-    # Get context based on ranked IDs
-    chunks = []
-    token_count = 0
-
-    for id in ranked["id"].tolist():
-        chunk = vault[id]["chunk"]
-        title = vault[id]["title"]
-
-        # Check if token count exceeds max_tokens
-        token_count += num_tokens_from_string(chunk, model_name)
-        if token_count > max_tokens:
-            break
-
-        chunks.append({"title": title, "chunk": chunk})
+    # Combine os and semantic hits and deduplicate chunks by ID, summing their OS and semantic scores
+    scores = defaultdict(int)
+    for hit in hits:
+        scores[hit["id"]] += 10 - hit["rank"]
+    ranked_ids = sorted(scores, key=scores.get, reverse=True)
+
+    # Get context based on ranked IDs (reading only their rows from the memory-mapped vault table), keeping chunks
+    # until the cumulative token count exceeds max_tokens
+    rows = pa.array([vault_index[id] for id in ranked_ids], type=pa.int64())
+    ranked = vault.take(rows)
+    if model_name == TOKEN_COUNT_MODEL:
+        token_counts = ranked.column("n_tokens").to_pylist()
+    else:
+        token_counts = num_tokens_from_strings(
+            ranked.column("chunk").to_pylist(), model_name
+        )
+    n_chunks = np.searchsorted(np.cumsum(token_counts), max_tokens, side="right")
 
-    return chunks
+    return ranked.select(["title", "chunk"]).slice(0, int(n_chunks)).to_pylist()
 
 
 @app.get("/get_chunks")
@@ -168,7 +179,7 @@ def get_chunks(query: str):
     logger.debug(f"OS hits: {os_hits}")
 
     # Get hits from semantic index
-    semantic_response = query_semantic(query, tokenizer, model, doc_embeddings_array)
+    semantic_response = query_semantic(query, tokenizer, model, semantic_index)
     semantic_hits = parse_semantic_response(semantic_response, embedding_index)
     logger.debug(f"Semantic hits: {semantic_hits}")
 
@@ -184,7 +195,7 @@ if __name__ == "__main__":
     os_hits = parse_os_response(os_response)
     logger.debug(f"OS hits: {os_hits}")
     semantic_response = query_semantic(
-        f"query: {test_query}", tokenizer, model, doc_embeddings_array
+        f"query: {test_query}", tokenizer, model, semantic_index
     )
     semantic_hits = parse_semantic_response(semantic_response, embedding_index)
     logger.debug(f"Semantic hits: {semantic_hits}")
@@ -2,12 +2,13 @@
 Reads vault dictionary and indexes documents into an opensearch index.
 """
 
-import pickle
+from typing import Iterator
 
 from opensearchpy import OpenSearch, RequestsHttpConnection
-from opensearchpy.helpers import bulk
+from opensearchpy.helpers import parallel_bulk
 
 from src.logger import logger
+from src.prep.build_vault_dict import VAULT_DOCS_PATH, load_vault
 
 INDEX_NAME = "obsidian-vault"
 
@@ -89,50 +90,66 @@ def create_index(client: OpenSearch, index_name: str) -> None:
     client.indices.create(index=index_name, body=index_body)
 
 
-def index_vault(vault: dict[str, dict], client: OpenSearch, index_name: str) -> None:
+def gen_actions(vault: dict[str, dict], index_name: str) -> Iterator[dict]:
     """
-    Index vault into opensearch index.
+    Lazily generate bulk index actions for each document in the vault.
 
     Args:
         vault: Obsidian vault dictionary
-        client: Opensearch client
-        index_name: Name of opensearh index
-    """
-    docs_indexed = 0
-    chunks_indexed = 0
-    docs = []
+        index_name: Name of opensearch index
 
-    for chunk_id, doc in vault.items():
+    Returns:
+        Iterator of bulk index actions
+    """
+    for docs_indexed, (chunk_id, doc) in enumerate(vault.items()):
         path = doc["path"]
-        title = doc["title"]
-        doc_type = doc["type"]
         chunk = doc["chunk"]
-        chunk_header = chunk[0]
-        docs_indexed += 1
         if docs_indexed % 100 == 0:
             logger.info(
                 f"Indexing {chunk_id} - Path: {path} (progress: {docs_indexed:,} docs)"
             )
 
-        docs.append(
-            {
-                "_index": index_name,
-                "_id": chunk_id,
-                "title": title,
-                "type": doc_type,
-                "path": path,
-                "chunk_header": chunk_header,
-                "chunk": chunk,
-            }
-        )
-        chunks_indexed += 1
+        yield {
+            "_index": index_name,
+            "_id": chunk_id,
+            "title": doc["title"],
+            "type": doc["type"],
+            "path": path,
+            "chunk_header": chunk[0],
+            "chunk": chunk,
+        }
 
-        if chunks_indexed % 2000 == 0:
-            bulk(client, docs)
-            docs = []
 
-    if chunks_indexed % 200 > 0:
-        bulk(client, docs)
+def index_vault(
+    vault: dict[str, dict],
+    client: OpenSearch,
+    index_name: str,
+    thread_count: int = 4,
+    chunk_size: int = 1000,
+) -> None:
+    """
+    Index vault into opensearch index, sending bulk requests from multiple threads.
+
+    Args:
+        vault: Obsidian vault dictionary
+        client: Opensearch client
+        index_name: Name of opensearh index
+        thread_count: Number of threads sending bulk requests. Defaults to 4.
+        chunk_size: Number of documents per bulk request. Defaults to 1,000.
+    """
+    chunks_indexed = 0
+
+    for ok, item in parallel_bulk(
+        client,
+        gen_actions(vault, index_name),
+        thread_count=thread_count,
+        chunk_size=chunk_size,
+        raise_on_error=False,
+    ):
+        if ok:
+            chunks_indexed += 1
+        else:
+            logger.warning(f"Failed to index: {item}")
 
     logger.info(f"Indexed {chunks_indexed:,} chunks (including full documents)")
 
@@ -191,8 +208,8 @@ def query_opensearch(
 
 
 if __name__ == "__main__":
-    # Load vault dictionary
-    vault = pickle.load(open("data/vault_dict.pickle", "rb"))
+    # Load vault dictionary of chunks and full docs
+    vault = {**load_vault(), **load_vault(VAULT_DOCS_PATH)}
     logger.info(f"Vault length: {len(vault):,}")
 
     # Create client
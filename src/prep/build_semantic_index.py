@@ -2,8 +2,10 @@
 Reads vault dictionary, creates embeddings for each chunk, and creates a semantic index.
 """
 
-import pickle
-from typing import List
+import os
+import re
+from contextlib import nullcontext
+from typing import List, Tuple, Union
 
 import numpy as np
 import torch
@@ -12,16 +14,64 @@ from torch import Tensor
 from transformers import AutoModel, AutoTokenizer
 
 from src.logger import logger
+from src.prep.build_vault_dict import load_vault
+
+# faiss is optional; without it, fall back to brute-force search on the embedding array
+try:
+    import faiss
+except ImportError:
+    faiss = None
 
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+HNSW_MIN_DOCS = 50_000  # Use approximate (HNSW) search for vaults with this many chunks
+SEARCH_BLOCK_SIZE = 8192  # Rows of int8 embeddings to dequantize at a time in search
+WHITESPACE_RE = re.compile(r"\s+")
 
 
 def average_pool(last_hidden_states: Tensor, attention_mask: Tensor) -> Tensor:
     """
     Average pool last hidden states, ignoring padding tokens.
     """
-    last_hidden = last_hidden_states.masked_fill(~attention_mask[..., None].bool(), 0.0)
-    return last_hidden.sum(dim=1) / attention_mask.sum(dim=1)[..., None]
+    # Multiply by the mask instead of masked_fill to avoid allocating an inverted boolean mask
+    mask = attention_mask.unsqueeze(-1).to(last_hidden_states.dtype)
+    summed = (last_hidden_states * mask).sum(dim=1)
+    return summed / mask.sum(dim=1).clamp_min(1e-6)
+
+
+def embed_tokenized(docs_tokenized, model) -> np.ndarray:
+    """
+    Embed a batch of tokenized documents.
+
+    Args:
+        docs_tokenized: Padded tensors of input_ids, attention_mask, etc. from the tokenizer
+        model: Model to embed documents
+
+    Returns:
+        Numpy array of batch-size x embedding-dim document embeddings
+    """
+    docs_tokenized = {key: val.to(model.device) for key, val in docs_tokenized.items()}
+
+    # Use half precision matmuls on GPU, falling back to float16 on GPUs without bfloat16 support. Autocast is only
+    # created for CUDA as CPU autocast warns on unsupported dtypes even when disabled (e.g., for the ONNX model).
+    if model.device.type == "cuda":
+        dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+        autocast = torch.autocast("cuda", dtype=dtype)
+    else:
+        autocast = nullcontext()
+
+    # Skip autograd bookkeeping as we only run inference
+    with torch.inference_mode(), autocast:
+        outputs = model(**docs_tokenized)
+
+    # Pool in float32 to keep normalization stable
+    embeddings = average_pool(
+        outputs.last_hidden_state.float(), docs_tokenized["attention_mask"]
+    )
+    embeddings_normed = F.normalize(
+        embeddings, p=2, dim=1
+    )  # Normalize embeddings for downstream cosine similarity
+
+    return embeddings_normed.detach().cpu().numpy()
 
 
 def get_batch_embeddings(
@@ -46,133 +96,208 @@ def get_batch_embeddings(
         truncation=True,
         return_tensors="pt",
     )
-    docs_tokenized = {key: val.to(DEVICE) for key, val in docs_tokenized.items()}
-    outputs = model(**docs_tokenized)
-    embeddings = average_pool(
-        outputs.last_hidden_state, docs_tokenized["attention_mask"]
-    )
-    embeddings_normed = F.normalize(
-        embeddings, p=2, dim=1
-    )  # Normalize embeddings for downstream cosine similarity
 
-    return embeddings_normed.detach().cpu().numpy()
+    return embed_tokenized(docs_tokenized, model)
 
 
-def build_embedding_index(vault: dict) -> dict[int, str]:
+def build_embedding_index(vault: dict) -> np.ndarray:
     """
     Build an index that maps document embedding row index to document chunk-id. Used to retrieve document id after ANN
     on document embeddings.
 
     Args:
-        vault: Dictionary of vault documents
+        vault: Dictionary of vault chunks
 
     Returns:
-        Mapping of document embedding row index to document chunk-id
+        Numpy array of document chunk-ids, where position i is the chunk-id of document embedding row i
     """
-    embedding_index = dict()
-    embedding_idx = 0
-
-    for chunk_id, doc in vault.items():
-        if doc["type"] == "doc":
-            continue  # Skip embedding full docs as they are too long for semantic search and take a long time
-
-        embedding_index[embedding_idx] = chunk_id
-        embedding_idx += 1
+    return np.array(list(vault))
 
-    return embedding_index
 
-
-def build_embedding_array(vault: dict, tokenizer, model, batch_size=4) -> np.ndarray:
+def build_embedding_array(vault: dict, tokenizer, model, batch_size=64) -> np.ndarray:
     """
-    Embedding all document chunks and return embedding array.
+    Embedding all document chunks and return embedding array. Chunks are batched by length to minimize padding.
 
     Args:
-        vault: Dictionary of vault documents
+        vault: Dictionary of vault chunks
         tokenizer: Tokenizer to tokenize documents; should be compatible with model
         model: Model to embed documents
-        batch_size: Size of document batch to embed each time. Defaults to 4.
+        batch_size: Size of document batch to embed each time. Defaults to 64.
 
     Returns:
-        Numpy array of n_chunks x embedding-dim document embeddings
-    """
-    docs_embedded = 0
-    chunk_batch = []
-    chunks_batched = 0
-    embedding_list = []
-
-    for chunk_id, doc in vault.items():
-        if doc["type"] == "doc":
-            continue  # Skip embedding full docs as they are too long for semantic search and take a long time
-
-        # Get path and chunks
-        if docs_embedded % 100 == 0:
-            logger.info(
-                f"Embedding document: {chunk_id} (progress: {docs_embedded:,} docs embedded)"
-            )
-        docs_embedded += 1
-        processed_chunk = "passage: " + " ".join(
-            doc["chunk"].split()
-        )  # Remove extra whitespace and add prefix
-
-        # logger.info(f'Chunk: {processed_chunk}')
-        chunk_batch.append(processed_chunk)  # Add chunk to batch
-        chunks_batched += 1
-
-        if chunks_batched % batch_size == 0:
-            # Compute embeddings in batch and append to list of embeddings
-            chunk_embeddings = get_batch_embeddings(chunk_batch, tokenizer, model)
-            embedding_list.append(chunk_embeddings)
-
-            # Reset batch
-            chunks_batched = 0
-            chunk_batch = []
-
-    # Add any remaining chunks to batch
-    if chunks_batched > 0:
-        chunk_embeddings = get_batch_embeddings(chunk_batch, tokenizer, model)
-        embedding_list.append(chunk_embeddings)
-
-    doc_embeddings_array = np.concatenate(embedding_list, axis=0)
-    # Reshape to 2D array where embedding dim is 2nd dim
-    doc_embeddings_array = np.reshape(
-        doc_embeddings_array, (-1, doc_embeddings_array.shape[-1])
+        Numpy array of n_chunks x embedding-dim document embeddings, in vault order
+    """
+    # Remove extra whitespace and add prefix
+    processed_chunks = [
+        "passage: " + WHITESPACE_RE.sub(" ", doc["chunk"]).strip()
+        for doc in vault.values()
+    ]
+
+    # Tokenize all chunks in a single call so the Rust tokenizer can parallelize across cores. Padding is deferred to
+    # each batch, as padding every chunk to the longest in the vault would waste compute. Only input_ids are kept for
+    # the whole vault: tokenizer.pad rebuilds the attention mask per batch and token type ids default to zeros.
+    input_ids = tokenizer(
+        processed_chunks,
+        max_length=512,
+        truncation=True,
+        return_attention_mask=False,
+        return_token_type_ids=False,
+    )["input_ids"]
+
+    # Sort chunks by token length so each batch has similar length chunks and little padding
+    order = sorted(range(len(input_ids)), key=lambda i: len(input_ids[i]))
+    doc_embeddings_array = np.empty(
+        (len(processed_chunks), model.config.hidden_size), dtype=np.float32
     )
+
+    for start in range(0, len(order), batch_size):
+        if start % (batch_size * 10) == 0:
+            logger.info(f"Embedding chunks (progress: {start:,} chunks embedded)")
+
+        # Compute embeddings in batch and write them to their rows in vault order
+        batch_indices = order[start : start + batch_size]
+        batch_tokenized = tokenizer.pad(
+            {"input_ids": [input_ids[i] for i in batch_indices]},
+            return_attention_mask=True,
+            return_tensors="pt",
+        )
+        doc_embeddings_array[batch_indices] = embed_tokenized(batch_tokenized, model)
+
     return doc_embeddings_array
 
 
-def query_semantic(query, tokenizer, model, doc_embeddings_array, n_results=10):
-    query_tokenized = tokenizer(
-        f"query: {query}",
-        max_length=512,
-        padding=False,
-        truncation=True,
-        return_tensors="pt",
-    ).to(DEVICE)
-    outputs = model(**query_tokenized)
-    query_embedding = average_pool(
-        outputs.last_hidden_state, query_tokenized["attention_mask"]
+def build_faiss_index(doc_embeddings_array: np.ndarray) -> "faiss.Index":
+    """
+    Build an approximate (HNSW) faiss index on document embeddings, for vaults too large for brute-force search. As
+    embeddings are L2-normalized, inner product = cosine similarity. Embeddings are stored with 8-bit scalar
+    quantization, cutting the index size by 4x like the int8 embeddings.
+
+    Args:
+        doc_embeddings_array: Numpy array of n_chunks x embedding-dim document embeddings
+
+    Returns:
+        Faiss HNSW index
+    """
+    dim = doc_embeddings_array.shape[1]
+    doc_embeddings_array = np.ascontiguousarray(doc_embeddings_array, dtype=np.float32)
+
+    index = faiss.IndexHNSWSQ(
+        dim, faiss.ScalarQuantizer.QT_8bit, 32, faiss.METRIC_INNER_PRODUCT
     )
-    query_embedding = F.normalize(query_embedding, p=2, dim=1).detach().cpu().numpy()
+    index.hnsw.efSearch = 64
+    # Training learns the per-dimension value ranges that the 8-bit codes cover
+    index.train(doc_embeddings_array)
+    index.add(doc_embeddings_array)
+
+    return index
+
+
+def quantize_embeddings(
+    doc_embeddings_array: np.ndarray,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Quantize document embeddings to int8 with a scale per embedding, cutting their size by 4x.
+
+    Args:
+        doc_embeddings_array: Numpy array of n_chunks x embedding-dim document embeddings
+
+    Returns:
+        Numpy array of n_chunks x embedding-dim int8 embeddings and n_chunks x 1 scales
+    """
+    doc_scales = 127.0 / np.abs(doc_embeddings_array).max(axis=1, keepdims=True)
+    doc_embeddings_int8 = (doc_embeddings_array * doc_scales).round().astype(np.int8)
+
+    return doc_embeddings_int8, doc_scales.astype(np.float32)
+
+
+def load_semantic_index(
+    faiss_path: str = "data/faiss.index",
+    embeddings_path: str = "data/doc_embeddings_int8.npy",
+    scales_path: str = "data/doc_embeddings_scale.npy",
+) -> Union["faiss.Index", Tuple[np.ndarray, np.ndarray]]:
+    """
+    Load the faiss index if faiss is installed and the index was built (only for large vaults), else the int8 document
+    embeddings.
+
+    Args:
+        faiss_path: Path to faiss index. Defaults to 'data/faiss.index'.
+        embeddings_path: Path to int8 document embeddings. Defaults to 'data/doc_embeddings_int8.npy'.
+        scales_path: Path to int8 embedding scales. Defaults to 'data/doc_embeddings_scale.npy'.
+
+    Returns:
+        Faiss index or tuple of int8 document embeddings and their scales
+    """
+    if faiss is not None and os.path.exists(faiss_path):
+        # The pinned faiss can't memory-map indexes, so each app worker loads its own copy of the HNSW index
+        return faiss.read_index(faiss_path)
+
+    logger.info(f"Faiss index not found, using brute-force search: {embeddings_path}")
+    # Memory-map the embeddings so pages are loaded on demand and shared across app workers
+    return np.load(embeddings_path, mmap_mode="r"), np.load(scales_path)
+
+
+def search_embeddings(
+    query_embedding: np.ndarray,
+    doc_embeddings_int8: np.ndarray,
+    doc_scales: np.ndarray,
+    n_results: int = 10,
+) -> np.ndarray:
+    """
+    Brute-force search for the int8 document embeddings most similar to the query embedding.
+
+    Args:
+        query_embedding: Numpy array of 1 x embedding-dim query embedding
+        doc_embeddings_int8: Numpy array of n_chunks x embedding-dim int8 document embeddings
+        doc_scales: Numpy array of n_chunks x 1 scales from quantize_embeddings
+        n_results: Number of results to return. Defaults to 10.
+
+    Returns:
+        Row indices of the top document embeddings, most similar first
+    """
+    query_embedding = query_embedding.flatten().astype(np.float32)
+    cos_sims = np.empty(len(doc_embeddings_int8), dtype=np.float32)
+
+    # Widen the int8 rows to float32 one block at a time and dot them with the float32 query, so the BLAS dot product
+    # never needs a full float32 copy of the embeddings.
+    for start in range(0, len(doc_embeddings_int8), SEARCH_BLOCK_SIZE):
+        block = doc_embeddings_int8[start : start + SEARCH_BLOCK_SIZE]
+        cos_sims[start : start + len(block)] = np.dot(
+            block.astype(np.float32), query_embedding
+        )
+    cos_sims /= doc_scales.flatten()
+
+    # Partition for the top n_results then sort only those, instead of sorting all cosine similarities
+    n_results = min(n_results, len(cos_sims))
+    top_indices = np.argpartition(cos_sims, -n_results)[-n_results:]
+
+    return top_indices[np.argsort(-cos_sims[top_indices])]
+
+
+def query_semantic(query, tokenizer, model, index, n_results=10):
+    query_embedding = get_batch_embeddings([f"query: {query}"], tokenizer, model)
 
-    cos_sims = np.dot(doc_embeddings_array, query_embedding.T)
-    cos_sims = cos_sims.flatten()
+    if isinstance(index, tuple):
+        return search_embeddings(query_embedding, *index, n_results=n_results)
 
-    top_indices = np.argsort(cos_sims)[-n_results:][::-1]
+    _, top_indices = index.search(query_embedding.astype(np.float32), n_results)
+    top_indices = top_indices[0]
 
-    return top_indices
+    return top_indices[top_indices >= 0]  # Faiss pads with -1 if < n_results embeddings
 
 
 if __name__ == "__main__":
-    # Load docs
-    vault = pickle.load(open("data/vault_dict.pickle", "rb"))
+    # Load chunks; full docs aren't embedded as they are too long for semantic search and take a long time
+    vault = load_vault()
     logger.info(f"Vault length: {len(vault):,}")
 
-    # Load tokenizer and model
+    # Load tokenizer and model. Unlike in the app, the tokenizer can use all cores for the whole vault offline.
+    os.environ["TOKENIZERS_PARALLELISM"] = "true"
     tokenizer = AutoTokenizer.from_pretrained(
         "intfloat/e5-small-v2"
     )  # Max token length is 512
     model = AutoModel.from_pretrained("intfloat/e5-small-v2")
     model.to(DEVICE)
+    model.eval()
 
     # Build and save embedding index and array
     embedding_index = build_embedding_index(vault)
@@ -182,9 +307,20 @@ if __name__ == "__main__":
         len(embedding_index) == doc_embeddings_array.shape[0]
     ), "Length of embedding index != embedding count"
 
-    with open("data/embedding_index.pickle", "wb") as f:
-        pickle.dump(embedding_index, f, protocol=pickle.HIGHEST_PROTOCOL)
-    np.save("data/doc_embeddings_array.npy", doc_embeddings_array)
+    np.save("data/embedding_index.npy", embedding_index)
+    doc_embeddings_int8, doc_scales = quantize_embeddings(doc_embeddings_array)
+    np.save("data/doc_embeddings_int8.npy", doc_embeddings_int8)
+    np.save("data/doc_embeddings_scale.npy", doc_scales)
+    index = (doc_embeddings_int8, doc_scales)
+
+    # Smaller vaults are served by brute-force search on the memory-mapped int8 embeddings, which app workers share
+    if faiss is not None and len(doc_embeddings_array) >= HNSW_MIN_DOCS:
+        index = build_faiss_index(doc_embeddings_array)
+        faiss.write_index(index, "data/faiss.index")
+        logger.info(f"Faiss index built with {index.ntotal:,} embeddings")
+    elif os.path.exists("data/faiss.index"):
+        # Remove an index left by an earlier build so the app doesn't serve it
+        os.remove("data/faiss.index")
 
     assert (
         len(embedding_index) == doc_embeddings_array.shape[0]
@@ -192,7 +328,7 @@ if __name__ == "__main__":
 
     # Test query
     test_query = "Examples of bandits in industry"
-    top_indices = query_semantic(test_query, tokenizer, model, doc_embeddings_array)
+    top_indices = query_semantic(test_query, tokenizer, model, index)
     logger.info(f"Test query: {test_query}, top indices: {top_indices}")
     for idx in top_indices:
         logger.info(f'Path: {vault[embedding_index[idx]]["path"]}')
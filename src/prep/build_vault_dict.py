@@ -6,42 +6,82 @@ chunk_id: {
     title: md_file_title,
     type: full or chunk,  # The former is the entire doc (for long context) while the latter is just a chunk
     path: md_file_path,
-    chunk: chunk  # If type = full, then the entire doc.
+    chunk: chunk,  # If type = full, then the entire doc.
+    n_tokens: n_tokens  # Number of tiktoken tokens in chunk, based on TOKEN_COUNT_MODEL
 }
 """
 
 import argparse
 import os
-import pickle
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List
+from typing import List, Tuple
+
+import pyarrow as pa
+import tiktoken
 
 from src.logger import logger
 
+# Downstream model to precompute chunk token counts for
+TOKEN_COUNT_MODEL = "gpt-3.5-turbo"
+VAULT_CHUNKS_PATH = "data/vault_chunks.arrow"
+VAULT_DOCS_PATH = "data/vault_docs.arrow"
+
+
+def count_lines(filename: Path, max_lines: int) -> int:
+    """
+    Count the number of lines in a file, streaming lines and stopping once more than max_lines are counted.
+
+    Args:
+        filename: Path to file.
+        max_lines: Stop counting once the line count exceeds this.
+
+    Returns:
+        Number of lines in the file, up to max_lines + 1.
+    """
+    line_count = 0
+
+    with open(filename, "r", encoding="latin-1") as f:
+        for _ in f:
+            line_count += 1
+            if line_count > max_lines:
+                break
 
-def get_file_paths(vault_path: str, min_lines: int = 5) -> List[str]:
+    return line_count
+
+
+def get_file_paths(
+    vault_path: str, min_lines: int = 5, max_workers: int = 16
+) -> List[str]:
     """
     Get all file paths in a vault.
 
     Args:
         vault_path: Path to obsidian vault.
         min_lines: Minimum number of lines in a file before being discarded. Defaults to 5.
+        max_workers: Number of threads to read files with. Defaults to 16.
 
     Returns:
         List of document paths.
     """
+    # exclude files in hidden directories
+    filenames = [
+        filename
+        for filename in Path(vault_path).rglob("*.md")
+        if not os.path.relpath(filename, start=vault_path).startswith(".")
+    ]
+
+    # Reading files is IO-bound, so count lines in threads to overlap disk reads
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        line_counts = executor.map(count_lines, filenames, [min_lines] * len(filenames))
+
     paths = []
 
-    for filename in Path(vault_path).rglob("*.md"):
-        # exclude files in hidden directories
-        if os.path.relpath(filename, start=vault_path).startswith("."):
-            continue
-        with open(filename, "r", encoding="latin-1") as f:
-            lines = f.readlines()
-            if len(lines) > min_lines:
-                relative_path = os.path.relpath(filename, start=vault_path)
-                paths.append(relative_path)
+    for filename, line_count in zip(filenames, line_counts):
+        if line_count > min_lines:
+            relative_path = os.path.relpath(filename, start=vault_path)
+            paths.append(relative_path)
 
     return paths
 
@@ -64,19 +104,21 @@ def chunk_doc_to_dict(lines: List[str], min_chunk_lines=3) -> dict[str, List[str
     current_header = None
 
     for line in lines:
-        if line.startswith("\n"):  # Skip empty lines
-            continue
-        if line.startswith("- tag"):  # Skip tags
-            continue
-        if line.startswith("- source"):  # Skip sources
+        # Dispatch on the first character(s) instead of calling startswith for every check
+        first = line[:1]
+        if first == "\n":  # Skip empty lines
             continue
         if "![](assets" in line:  # Skip lines that are images
             continue
 
-        if line.startswith("#"):  # Chunk header = Section header
+        is_bullet = first == "-" and line[1:2] == " "
+        if is_bullet and (line[:5] == "- tag" or line[:8] == "- source"):
+            continue  # Skip tags and sources
+
+        if first == "#":  # Chunk header = Section header
             current_header = line
 
-        if line.startswith("- "):  # Top-level bullet
+        if is_bullet:  # Top-level bullet
             if current_chunk:  # If chunks accumulated, add it to chunks
                 if len(current_chunk) >= min_chunk_lines:
                     chunks[chunk_idx] = current_chunk
@@ -107,6 +149,7 @@ def create_vault_dict(vault_path: str, paths: List[str]) -> dict[str, dict[str,
         Dictionary of full docs and chunks in a vault
     """
     vault = dict()
+    encoding = tiktoken.encoding_for_model(TOKEN_COUNT_MODEL)
 
     for filename in paths:
         with open(
@@ -135,11 +178,13 @@ def create_vault_dict(vault_path: str, paths: List[str]) -> dict[str, dict[str,
 
             if len(chunks) > 0:  # Only add docs with chunks to dict
                 # Add full document to vault dict (for retrieving the entire doc + longer context)
+                doc_str = "".join(lines)
                 vault[filename] = {
                     "title": filename,
                     "type": "doc",  # This is a full document
                     "path": str(filename),
-                    "chunk": "".join(lines),
+                    "chunk": doc_str,
+                    "n_tokens": len(encoding.encode_ordinary(doc_str)),
                 }
 
                 # sometimes, notes follow a template and thus are quite repetitive. For example, stubs for meeting notes.
@@ -163,12 +208,73 @@ def create_vault_dict(vault_path: str, paths: List[str]) -> dict[str, dict[str,
                         "title": filename,
                         "type": "chunk",  # This is a chunk
                         "path": str(filename),
-                        "chunk": "".join(chunk),
+                        "chunk": chunk_str,
+                        "n_tokens": len(encoding.encode_ordinary(chunk_str)),
                     }
 
     return vault
 
 
+def save_vault(
+    vault: dict[str, dict],
+    chunks_path: str = VAULT_CHUNKS_PATH,
+    docs_path: str = VAULT_DOCS_PATH,
+) -> None:
+    """
+    Save vault dictionary as uncompressed Arrow IPC files with one row per chunk_id, in vault order. Chunks and full
+    docs are saved separately so downstream steps that only need chunks (semantic index, app) don't have to filter out
+    full docs.
+
+    Args:
+        vault: Dictionary of full docs and chunks in a vault
+        chunks_path: Path to save chunks to. Defaults to 'data/vault_chunks.arrow'.
+        docs_path: Path to save full docs to. Defaults to 'data/vault_docs.arrow'.
+    """
+    for doc_type, path in (("chunk", chunks_path), ("doc", docs_path)):
+        table = pa.Table.from_pylist(
+            [
+                {"id": chunk_id, **doc}
+                for chunk_id, doc in vault.items()
+                if doc["type"] == doc_type
+            ]
+        )
+        with pa.OSFile(path, "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+
+
+def load_vault_table(path: str = VAULT_CHUNKS_PATH) -> Tuple[pa.Table, dict[str, int]]:
+    """
+    Memory-map a vault table saved by save_vault. Columns are read zero-copy from the file, so only the id -> row
+    index is built in Python; chunk text stays in the page cache until rows are read.
+
+    Args:
+        path: Path to Arrow IPC file. Defaults to 'data/vault_chunks.arrow'.
+
+    Returns:
+        Vault table with id, title, type, path, chunk, and n_tokens columns, and mapping of chunk_id to table row
+    """
+    table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+    row_index = dict(zip(table.column("id").to_pylist(), range(table.num_rows)))
+
+    return table, row_index
+
+
+def load_vault(path: str = VAULT_CHUNKS_PATH) -> dict[str, dict]:
+    """
+    Load vault dictionary from a table saved by save_vault. This copies every row into Python, which suits the prep
+    scripts that iterate the whole vault; the app uses load_vault_table instead.
+
+    Args:
+        path: Path to Arrow IPC file. Defaults to 'data/vault_chunks.arrow'.
+
+    Returns:
+        Dictionary of chunks (or full docs) in a vault
+    """
+    table, _ = load_vault_table(path)
+    return {doc.pop("id"): doc for doc in table.to_pylist()}
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Create vault dictionary")
     parser.add_argument(
@@ -179,5 +285,4 @@ if __name__ == "__main__":
     paths = get_file_paths(args.vault_path)
     vault = create_vault_dict(args.vault_path, paths)
     logger.info(f"Number of docs in vault: {len(vault):,}")
-    with open("data/vault_dict.pickle", "wb") as f:
-        pickle.dump(vault, f, protocol=pickle.HIGHEST_PROTOCOL)
+    save_vault(vault)